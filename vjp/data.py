@@ -1,11 +1,14 @@
 """Data loading and manipulation."""
 import os
-import copy
-from typing import List, Sequence, Tuple
-import xml.etree.ElementTree as ET
-from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from typing import (Dict, FrozenSet, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple, Union)
+from itertools import accumulate, chain
+from operator import methodcaller
 
 import importlib_resources as resources
+from lxml import etree as ET
 import pandas as pd
 import networkx as nx
 import re
@@ -20,25 +23,51 @@ LINK_SEPARATOR = r'|'
 EDGE_RELATIONS = {'O', 'D', 'PRO', 'SUP', 'ATT', 'CON', 'REPH'}
 """Tag attributes that can be used as relations in a graph."""
 
+ADMISSIBLE_OUTCOMES = '0', '1'
+"""Decision outcomes (``E`` attribute) considered as labels."""
+
+_ALL_WHITES_RE = re.compile(r'\s+')
+
+# Precompiled XPath queries
+_ID_QUERY = ET.XPath(".//*[@ID]")
+_GRADE_ID_QUERY = ET.XPath(".//*[@G=$proc]/*[@ID]")
+_DECISIONS_QUERY = ET.XPath(".//courtdec[@G='2']/dec")
+_DECISIONS_PARENT_QUERY = ET.XPath("(.//courtdec[@G='2'])[1]/..")
+_FACT_QUERY = ET.XPath("(.//fact)[1]")
+
+
+def _make_parser() -> ET.XMLParser:
+    """Return a new XML parser for the dataset instances.
+
+    Comments and processing instructions are dropped, consistently with
+    the behaviour of the standard library parser. A new parser shall
+    be created for each thread, as lxml parsers are not thread safe.
+    """
+    return ET.XMLParser(huge_tree=True, collect_ids=False,
+                        remove_comments=True, remove_pis=True)
+
 
 def load_instance_raw(file: os.PathLike) -> ET.Element:
     """Load and return an XML instance tree, with no cleanup."""
-    root = ET.parse(file).getroot()
-    root.set('source_file', file)
+    root = ET.parse(file, _make_parser()).getroot()
+    root.set('source_file', os.fspath(file))
     return root
 
 
-def load_directory(directory: resources.abc.Traversable) -> List[ET.Element]:
+def load_directory(directory: resources.abc.Traversable,
+                   max_workers: Optional[int] = None) -> List[ET.Element]:
     """Load all instances from a given directory in a list.
 
     Does not explore subdirectories.
+
+    Files are parsed concurrently by a pool of ``max_workers`` threads
+    (lxml releases the GIL while parsing). If ``None``, the default of
+    :class:`concurrent.futures.ThreadPoolExecutor` is used.
     """
-    instances = []
-    for file in directory.iterdir():
-        if file.is_file():
-            instances.append(load_instance_raw(file))
+    files = [file for file in directory.iterdir() if file.is_file()]
 
-    return instances
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(load_instance_raw, files))
 
 
 def load_second_instance() -> List[ET.Element]:
@@ -64,45 +93,164 @@ def load_second_instance_labeled() -> Tuple[List[ET.Element],
             load_directory(resources.files(SECOND_INSTANCE_REJECT_RESOURCES)))
 
 
-def findall(instances: Sequence[ET.Element], query: str) -> List[ET.Element]:
+def query_instance(instance: ET.Element,
+                   query: Union[str, ET.XPath]) -> List[ET.Element]:
+    """Execute an XPath query on an instance.
+
+    ``query`` can either be a string in the ElementPath syntax or a
+    precompiled :class:`lxml.etree.XPath`.
+    """
+    if isinstance(query, str):
+        return instance.findall(query)
+
+    return query(instance)
+
+
+def findall_flat(instances: Sequence[ET.Element],
+                 query: Union[str, ET.XPath]) -> List[ET.Element]:
+    """Execute an XPath query on all given instances.
+
+    See :func:`query_instance` for the accepted queries.
+
+    Return: a flattened output list of all the results.
+    """
+    return list(chain.from_iterable(query_instance(instance, query)
+                                    for instance in instances))
+
+
+def findall_with_source(instances: Sequence[ET.Element],
+                        query: Union[str, ET.XPath]
+                        ) -> Tuple[List[ET.Element],
+                                   Dict[ET.Element, ET.Element]]:
     """Execute an XPath query on all given instances.
 
+    See :func:`query_instance` for the accepted queries.
+
     Return: a flattened output list of all the results and a mapping
     from the results to the corresponding queried elements.
     """
     mapping = {}
     for instance in instances:
-        for result in instance.findall(query):
+        for result in query_instance(instance, query):
             mapping[result] = instance
 
-    return list(mapping.keys()), mapping
+    return list(mapping), mapping
 
 
-def filter_other_outcomes(instances: List[ET.Element]) -> List[ET.Element]:
+def findall(instances: Sequence[ET.Element],
+            query: Union[str, ET.XPath]
+            ) -> Tuple[List[ET.Element], Dict[ET.Element, ET.Element]]:
+    """Execute an XPath query on all given instances.
+
+    Same as :func:`findall_with_source`. Prefer :func:`findall_flat`
+    when the mapping is not needed.
+    """
+    return findall_with_source(instances, query)
+
+
+def _has_admissible_decision(instance: ET.Element) -> bool:
+    """Return whether an instance has at least an admissible outcome.
+
+    Not memoized: a cache keyed on instances would keep whole parsed
+    documents alive.
+    """
+    return any(decision.get('E') in ADMISSIBLE_OUTCOMES
+               for decision in _DECISIONS_QUERY(instance))
+
+
+def filter_other_outcomes(instances: Iterable[ET.Element]
+                          ) -> List[ET.Element]:
     """Return instances with at least an admissible outcome.
 
-    Data is copied.
+    Input order is kept, duplicates are removed. Instances may be given
+    lazily (e.g. while loading them), discarded ones are then never
+    held all at once.
+    """
+    return list(dict.fromkeys(instance for instance in instances
+                              if _has_admissible_decision(instance)))
+
+
+def iterparse_decisions(file: os.PathLike) -> Iterator[ET.Element]:
+    """Iterate over the second instance decisions of an XML instance.
+
+    Unlike :func:`load_instance_raw`, the instance is parsed
+    incrementally and never built as a whole: parsed elements are
+    cleared as soon as possible, keeping memory usage constant. Useful
+    for bulk scans that are only interested in decisions.
+
+    Yielded elements are cleared when the iteration is resumed,
+    they shall not be stored.
     """
-    decisions, decision_mapping = findall(instances,
-                                          ".//courtdec[@G='2']/dec")
-    upheld, _ = findall(decisions, ".[@E='1']")
-    rejected, _ = findall(decisions, ".[@E='0']")
+    for _, element in ET.iterparse(file, events=('end',), huge_tree=True,
+                                   remove_comments=True, remove_pis=True):
+        if element.tag == 'dec':
+            parent = element.getparent()
+            if parent.tag == 'courtdec' and parent.get('G') == '2':
+                yield element
+        elif any(True for _ in element.iterancestors('dec')):
+            # Keep decisions' content until they are fully parsed
+            continue
+
+        element.clear(keep_tail=True)
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def has_admissible_outcome(file: os.PathLike) -> bool:
+    """Return whether an XML instance has at least an admissible outcome.
+
+    Equivalent to :func:`filter_other_outcomes` on a single instance,
+    but the file is streamed via :func:`iterparse_decisions` instead of
+    being fully loaded.
+    """
+    return any(decision.get('E') in ADMISSIBLE_OUTCOMES
+               for decision in iterparse_decisions(file))
+
 
-    decisions = upheld + rejected
-    return list(set(decision_mapping[decision] for decision in decisions))
+@lru_cache(maxsize=100000)
+def _split_links(links: str) -> Tuple[str, ...]:
+    """Split a string of links, memoized (see :func:`extract_link`)."""
+    return tuple(links.split(LINK_SEPARATOR))
 
 
-def extract_link(element: ET.Element, key: str) -> List[str]:
-    """Extract a list of linked element ids from an element's argument.
+def extract_link(element: ET.Element, key: str) -> Tuple[str, ...]:
+    """Extract a sequence of linked element ids from an element's argument.
 
     Links are considered to be separated by a pipe
     (:attr:`LINK_SEPARATOR`).
     """
-    return element.attrib[key].split(LINK_SEPARATOR)
+    return _split_links(element.attrib[key])
+
+
+def build_id_index(document: ET.Element,
+                   proc=None) -> Dict[str, ET.Element]:
+    """Map tag IDs to the corresponding elements of a document.
+
+    The index is built in a single pass over the document, so that
+    repeated lookups by ID do not need to scan the whole document.
+    If an ID is not unique, the first element in document order is
+    kept.
+
+    ``proc`` specifies the grade (``G`` attribute of the parent) to
+    consider. If set to ``None``, no filtering by grade is performed.
+    Defaults to ``None``.
+    """
+    if proc is None:
+        elements = _ID_QUERY(document)
+    else:
+        elements = _GRADE_ID_QUERY(document, proc=str(proc))
+
+    id_index = {}
+    for element in elements:
+        id_index.setdefault(element.get('ID'), element)
+
+    return id_index
 
 
 def extract_link_elements(document: ET.Element, element: ET.Element,
-                          key: str, proc=2) -> List[ET.Element]:
+                          key: str, proc=2,
+                          id_index: Optional[Dict[str, ET.Element]] = None
+                          ) -> List[ET.Element]:
     """Extract a list of linked elements from an element's argument.
 
     Uses :func:`extract_link` to get the ids and retrieves them from
@@ -111,23 +259,34 @@ def extract_link_elements(document: ET.Element, element: ET.Element,
     ``proc`` specifies the grade (``G`` attribute) to consider. If
     set to ``None``, no filtering by grade is performed. Defaults to
     ``2``.
+
+    ``id_index`` can be used to reuse an index built by
+    :func:`build_id_index` with the same ``proc``, when extracting
+    many links from the same document. If not given, it is built on
+    the fly.
     """
+    if id_index is None:
+        id_index = build_id_index(document, proc)
+
     links = extract_link(element, key)
 
     link_elements = []
     for link_id in links:
         # IDs shall be unique
-        query = f".//*[@G='{proc}']/*[@ID='{link_id}']"
-        if proc is None:
-            query = f".//*[@ID='{link_id}']"
-
-        element = document.find(query)
+        element = id_index.get(link_id)
         if element is not None:
             link_elements.append(element)
 
     return link_elements
 
 
+@lru_cache(maxsize=None)
+def _relations_query(relations: FrozenSet[str]) -> ET.XPath:
+    """Compile a query for the elements having any of the relations."""
+    condition = ' or '.join(f'@{relation}' for relation in sorted(relations))
+    return ET.XPath(f'.//*[{condition}]')
+
+
 def build_tag_triples(document: ET.Element,
                       relations: Sequence[str] = EDGE_RELATIONS
                       ) -> pd.DataFrame:
@@ -139,32 +298,95 @@ def build_tag_triples(document: ET.Element,
     Tags that are not implied in any relation are ignored.
     """
     # Perform a DFS starting, starting from all sources having the
-    # desired attribute
-    fringe = sum(
-        (document.findall(f'.//*[@{relation}]') for relation in relations),
-        start=[])
+    # desired attribute. Sources are collected in a single pass.
+    relations = frozenset(relations)
+    fringe = _relations_query(relations)(document) if relations else []
+
+    id_index = build_id_index(document, proc=2)
 
+    # Triples are stored as single integers, packing the indeces of
+    # the interned source and target IDs and of the relation. Cheaper
+    # to hash than tuples of strings.
+    ids = {}
+    edge_relations = tuple(EDGE_RELATIONS)
     triples = set()
 
     while fringe:
         source = fringe.pop()
+        source_key = ids.setdefault(source.get('ID'), len(ids)) << 40
 
-        # For each relation defined by the element
-        for relation in EDGE_RELATIONS.intersection(source.attrib):
-            targets = extract_link_elements(document, source, relation)
+        # For each relation defined by the element. Relations are few,
+        # look them up instead of going through all the attributes.
+        for relation_index, relation in enumerate(edge_relations):
+            if source.get(relation) is None:
+                continue
+
+            targets = extract_link_elements(document, source, relation,
+                                            id_index=id_index)
 
             # Generate a triple for each target of said relation
             # If a duplicate is found, drop current element, it's an
             # infinite loop
             for target in targets:
-                triple = (source.get('ID'), target.get('ID'), relation)
+                triple = (source_key
+                          | ids.setdefault(target.get('ID'), len(ids)) << 8
+                          | relation_index)
                 if triple in triples:
                     break
 
                 triples.add(triple)
                 fringe.append(target)
 
-    return pd.DataFrame(triples, columns=['source', 'target', 'edge'])
+    # Unpack triples
+    id_names = list(ids)
+    columns = {'source': [], 'target': [], 'edge': []}
+    for triple in triples:
+        columns['source'].append(id_names[triple >> 40])
+        columns['target'].append(id_names[triple >> 8 & 0xFFFFFFFF])
+        columns['edge'].append(edge_relations[triple & 0xFF])
+
+    return pd.DataFrame(columns)
+
+
+def graphs_from_triples(triples: Sequence[pd.DataFrame]
+                        ) -> List[nx.DiGraph]:
+    """Build a directed graph from each dataframe of triples.
+
+    Triples are given as in :func:`build_tag_triples`, relations are
+    stored in the ``edge`` attribute of each edge. Graphs are the same
+    as those built by ``networkx.from_pandas_edgelist``, but all
+    triples are converted from pandas at once and edges are added
+    directly.
+    """
+    if not triples:
+        return []
+
+    all_triples = pd.concat(triples, ignore_index=True)
+    sources = all_triples['source'].tolist()
+    targets = all_triples['target'].tolist()
+    edges = all_triples['edge'].tolist()
+
+    bounds = list(accumulate(map(len, triples), initial=0))
+    graphs = []
+    for start, stop in zip(bounds, bounds[1:]):
+        graph = nx.DiGraph()
+        graph.add_edges_from(zip(sources[start:stop], targets[start:stop],
+                                 ({'edge': edge}
+                                  for edge in edges[start:stop])))
+        graphs.append(graph)
+
+    return graphs
+
+
+@lru_cache(maxsize=None)
+def _tag_prefixes_re(tag_names: Tuple[str, ...]) -> re.Pattern:
+    """Compile a regex matching any of the given prefixes.
+
+    Each prefix is captured by its own group. Alternatives are tried in
+    order, so the first matching prefix wins.
+    """
+    return re.compile('|'.join(f'({re.escape(name)})' for name in tag_names)
+                      or '(?!)')
 
 
 def tagid_in_sequence(tagid: str, tag_names: Sequence[str]) -> int:
@@ -173,19 +395,20 @@ def tagid_in_sequence(tagid: str, tag_names: Sequence[str]) -> int:
     The index of the related name in the sequence is returned (``-1``
     if not found).
     """
-    for i, prefix in enumerate(tag_names):
-        if tagid.lower().startswith(prefix):
-            return i
+    match = _tag_prefixes_re(tuple(tag_names)).match(tagid.lower())
+    if match is None:
+        return -1
 
-    return -1
+    return match.lastindex - 1
 
 
 def get_node_sub_text(node_element: ET.Element) -> str:
-    ret = ''.join(get_node_sub_text(child) for child in list(node_element)
-                  if child.text is not None)
-    if node_element.text is not None:
-        return (re.sub(r'\s+', ' ', node_element.text) + ' ' + ret).strip()
-    return ret
+    """Return all the text contained by an element and its descendants.
+
+    Text fragments are joined in document order, whitespaces are
+    normalized to a single space.
+    """
+    return _ALL_WHITES_RE.sub(' ', ' '.join(node_element.itertext())).strip()
 
 
 def dataframe_from_graphs(
@@ -212,13 +435,42 @@ def dataframe_from_graphs(
     assert len(graphs) == len(samples), (
         'Graph and sample lists must have the same amount of elements')
 
-    df_list = []
+    use_child_text_prefixes = tuple(use_child_text_tag_names)
+    req_prefix_index = tag_names.index('req')
+
+    # The same IDs recur across documents (e.g. Req1), classify each of
+    # them only once
+    tag_index = lru_cache(maxsize=None)(
+        partial(tagid_in_sequence, tag_names=tuple(tag_names)))
+    decision_index = lru_cache(maxsize=None)(
+        partial(tagid_in_sequence, tag_names=('dec',)))
+
+    columns = {'document_index': [], 'fact': [],
+               **{tag_name: [] for tag_name in tag_names}, 'label': []}
     for document_index, (graph, document) in enumerate(zip(graphs, samples)):
-        for component in tuple(nx.connected_components(graph.to_undirected())):
-            # Extract decisional tags
-            dec_ids = tuple(filter(
-                lambda id_: tagid_in_sequence(id_, ('dec',)) == 0,
-                component))
+        id_index = build_id_index(document)
+
+        # Fact column, shared by all the records of a document
+        fact_elements = _FACT_QUERY(document)
+        fact = ''
+        if fact_elements:
+            fact = fact_elements[0].text
+
+        # Graphs are small (one per document), components are cheap to
+        # compute even in pure Python
+        if graph.is_directed():
+            components = nx.weakly_connected_components(graph)
+        else:
+            components = nx.connected_components(graph)
+
+        for component in components:
+            # Classify nodes and extract decisional tags in a single pass
+            classified_nodes = []
+            dec_ids = []
+            for node in component:
+                classified_nodes.append((node, tag_index(node)))
+                if decision_index(node) == 0:
+                    dec_ids.append(node)
 
             # Decisions represent labels, skip if none is found
             if not dec_ids:
@@ -227,7 +479,7 @@ def dataframe_from_graphs(
             # Also skip if the label is not 0 or 1
             # NB: How to handle multiple decisions in one connected component?
             label = -1
-            dec_element = document.find(f".//*[@ID='{dec_ids[0]}']")
+            dec_element = id_index.get(dec_ids[0])
             try:
                 label = int(dec_element.get('E'))
                 if label not in (0, 1):
@@ -238,39 +490,35 @@ def dataframe_from_graphs(
             # Build a sequence per tag type
             concat_lists = [[] for _ in tag_names]
 
-            node_indeces = map(lambda id_: tagid_in_sequence(id_, tag_names),
-                               component)
-
-            for node, index in zip(component, node_indeces):
-                node_element = document.find(f".//*[@ID='{node}']")
+            for node, index in classified_nodes:
                 if index >= 0:
-                    if any(node.lower().startswith(tag)
-                           for tag in use_child_text_tag_names):
+                    node_element = id_index.get(node)
+                    if node.lower().startswith(use_child_text_prefixes):
                         concat_lists[index].append(
                             get_node_sub_text(node_element))
                     elif node_element.text is not None:
                         concat_lists[index].append(
-                            re.sub(r'\s+', ' ', node_element.text).strip())
-
-            # Add fact column
-            fact_element = document.find(".//fact")
-            fact = ''
-            if fact_element is not None:
-                fact = fact_element.text
+                            _ALL_WHITES_RE.sub(' ', node_element.text)
+                            .strip())
 
-            req_prefix_index = tag_names.index('req')
+            # One record per request, other tags are shared
+            record = [document_index, fact,
+                      *map(join_token.join, concat_lists), label]
             for req_text in concat_lists[req_prefix_index]:
-                df_list.append([document_index, fact, *map(join_token.join,
-                                                           concat_lists),
-                                label])
-                df_list[-1][1 + req_prefix_index] = req_text
+                record[1 + req_prefix_index] = req_text
+
+                for column, value in zip(columns.values(), record):
+                    column.append(value)
 
-    return pd.DataFrame(df_list, columns=['document_index', 'fact', *tag_names,
-                                          'label'])
+    return pd.DataFrame(columns)
 
 
 def sort_documents(documents: Sequence[ET.Element]) -> Sequence[ET.Element]:
-    return sorted(documents, key=lambda x: x.get('source_file'))
+    """Sort documents by source file, as set by :func:`load_instance_raw`.
+
+    Gives a deterministic order, independent from the loading order.
+    """
+    return sorted(documents, key=methodcaller('get', 'source_file'))
 
 
 def count_based_X_y(dataframe: pd.DataFrame, tag_names=('fact',),
@@ -287,6 +535,27 @@ def count_based_X_y(dataframe: pd.DataFrame, tag_names=('fact',),
     )
 
 
+def _collect_text(element: ET.Element, excluded: Sequence[ET.Element],
+                  parts: List[str]):
+    """Collect the text of an element, skipping excluded subelements.
+
+    Text is collected as in a ``method='text'`` serialization, tails of
+    excluded subelements are skipped as well.
+    """
+    if element.text:
+        parts.append(element.text)
+
+    for child in element:
+        if child in excluded:
+            continue
+
+        # Comments and processing instructions only contribute tails
+        if isinstance(child.tag, str):
+            _collect_text(child, excluded, parts)
+        if child.tail:
+            parts.append(child.tail)
+
+
 def shot_based_document(document: ET.Element, only_proc: bool=True) -> Tuple[str, str]:
     """Split a document in: preliminary part and decisional part.
 
@@ -294,39 +563,30 @@ def shot_based_document(document: ET.Element, only_proc: bool=True) -> Tuple[str
     order. Mostly used for x-shot learning on large language models that
     could benefit from the cronological order of the document.
 
-    Data is internally copied to prevent modifications on input
-    documents.
+    Input documents are not modified.
     """
-    document_copy = copy.deepcopy(document)
-    
-    
-
-
-    decision_element_parent = document_copy.find(".//courtdec[@G='2']/..")
-    if decision_element_parent is None:
+    decision_element_parents = _DECISIONS_PARENT_QUERY(document)
+    if not decision_element_parents:
         raise ValueError('No decision found in the given document')
+    decision_element_parent = decision_element_parents[0]
 
     # Parent of decision and motivation elements is supposed to be the same
     decision_element = decision_element_parent.find('./courtdec')
     motivation_element = decision_element_parent.find('./courtmot')
 
-    decision_split_strings = []
-
+    decision_split_elements = [decision_element]
     if motivation_element is not None:
-        decision_split_strings.append(
-            ET.tostring(motivation_element, method='text', encoding='unicode'))
+        decision_split_elements.insert(0, motivation_element)
 
-        # Remove mot/decision elements in order to get a split with
-        # preliminaries only
-        decision_element_parent.remove(motivation_element)
-    decision_element_parent.remove(decision_element)
+    # Preliminaries are made of everything but motivation and decision
+    preliminary_parts = []
+    _collect_text(document, decision_split_elements, preliminary_parts)
 
-    decision_split_strings.append(ET.tostring(decision_element, method='text',
-                                              encoding='unicode'))
+    decision_split_strings = [
+        ET.tostring(element, method='text', encoding='unicode')
+        for element in decision_split_elements]
 
-    return (
-        ET.tostring(document_copy, method='text', encoding='unicode'),
-        '\n'.join(decision_split_strings))
+    return ''.join(preliminary_parts), '\n'.join(decision_split_strings)
 
 
 def shot_based_dataframe(upheld: Sequence[ET.Element],
@@ -1,24 +1,238 @@
+import math
+import time
 from typing import List, Tuple, Iterable
 from itertools import chain
-from operator import or_
-from functools import reduce
 
 import pandas as pd
 import numpy as np
-from pulp import LpProblem, LpVariable, lpSum, COIN
-from pulp import const
+import scipy.sparse as sparse
+from scipy.optimize import milp, Bounds, LinearConstraint
+
+
+def _greedy_assignment(samples: np.ndarray, num_folds: int) -> np.ndarray:
+    """Assign samples to folds greedily.
+
+    Samples are considered by decreasing number of labels, each one is
+    assigned to the fold having the least labels so far.
+
+    Return an array containing the fold index of each sample.
+    """
+    assignment = np.empty(len(samples), dtype=int)
+    fold_totals = np.zeros(num_folds, dtype=samples.dtype)
+    sample_totals = samples.sum(axis=1)
+
+    for sample_index in np.argsort(-sample_totals, kind='stable'):
+        fold_index = fold_totals.argmin()
+        assignment[sample_index] = fold_index
+        fold_totals[fold_index] += sample_totals[sample_index]
+
+    return assignment
+
+
+def _assignment_cost(samples: np.ndarray, assignment: np.ndarray,
+                     num_folds: int, fold_ratio: float) -> Tuple[float, float]:
+    """Cost of an assignment of samples to folds.
+
+    Return the maximum distance of the fold label counts from the target
+    amount, and the sum of the squared distances. Costs shall be
+    compared lexicographically.
+    """
+    fold_counts = np.zeros((num_folds, 2))
+    np.add.at(fold_counts, assignment, samples)
+    distances = np.abs(fold_counts - fold_ratio)
+
+    return distances.max(), (distances ** 2).sum()
+
+
+def _local_search(samples: np.ndarray, assignment: np.ndarray,
+                  num_folds: int, fold_ratio: float,
+                  deadline: float) -> np.ndarray:
+    """Improve an assignment by exchanging samples between folds.
+
+    Each sample is in turn moved to another fold or swapped with a
+    sample of another fold, picking the best exchange if it reduces the
+    cost (see :func:`_assignment_cost`). The sum of squared distances
+    breaks ties of the maximum distance, letting the search move across
+    its plateaus.
+
+    Stop when no exchange improves the assignment, or when the
+    ``deadline`` (see :func:`time.monotonic`) is met.
+    Return a new assignment.
+    """
+    num_samples = len(samples)
+
+    # Exchange partners: all samples, followed by one empty sample per
+    # fold (i.e. a simple move to that fold)
+    partners = np.concatenate((samples, np.zeros((num_folds, 2))))
+    partner_folds = np.concatenate((assignment, np.arange(num_folds)))
+    partners_range = np.arange(len(partners))
+
+    fold_counts = np.zeros((num_folds, 2))
+    np.add.at(fold_counts, assignment, samples)
+    cost = _assignment_cost(samples, assignment, num_folds, fold_ratio)
+
+    improved = True
+    while improved and time.monotonic() < deadline:
+        improved = False
+
+        for sample_index in range(num_samples):
+            sample_fold = partner_folds[sample_index]
+
+            # Fold counts after each possible exchange
+            exchanged_counts = np.repeat(fold_counts[None], len(partners),
+                                         axis=0)
+            exchanged_counts[:, sample_fold] += partners - samples[
+                sample_index]
+            exchanged_counts[partners_range, partner_folds] += (
+                samples[sample_index] - partners)
+
+            distances = np.abs(exchanged_counts - fold_ratio)
+            max_distances = distances.max(axis=(1, 2))
+            squared_distances = (distances ** 2).sum(axis=(1, 2))
+
+            # Exchanges within the same fold are meaningless
+            max_distances[partner_folds == sample_fold] = np.inf
+
+            best = np.lexsort((squared_distances, max_distances))[0]
+            best_cost = max_distances[best], squared_distances[best]
+            if (best_cost[0] > cost[0]
+                    or (best_cost[0] == cost[0]
+                        and best_cost[1] >= cost[1] - 1e-9)):
+                continue
+
+            partner_fold = partner_folds[best]
+            fold_counts[sample_fold] += partners[best] - samples[sample_index]
+            fold_counts[partner_fold] += samples[sample_index] - partners[best]
+            if best < num_samples:
+                partner_folds[best] = sample_fold
+            partner_folds[sample_index] = partner_fold
+
+            cost = best_cost
+            improved = True
+
+    return partner_folds[:num_samples]
+
+
+def _heuristic_assignment(samples: np.ndarray, num_folds: int,
+                          max_seconds: float, seed=None,
+                          restarts=4) -> np.ndarray:
+    """Assign samples to balanced folds through a multi-start heuristic.
+
+    A local search (:func:`_local_search`) is started from the greedy
+    assignment (:func:`_greedy_assignment`) and from ``restarts``
+    random ones, the best result is kept. Random assignments are
+    seeded by ``seed`` (``0`` if ``None``), so that results are
+    reproducible.
+
+    Return an array containing the fold index of each sample.
+    """
+    fold_ratio = samples.sum() / (num_folds * 2)
+    deadline = time.monotonic() + max_seconds
+    rng = np.random.default_rng(0 if seed is None else seed)
+
+    starts = chain((_greedy_assignment(samples, num_folds),),
+                   (rng.integers(num_folds, size=len(samples))
+                    for _ in range(restarts)))
+
+    best_assignment = None
+    best_cost = None
+    for start in starts:
+        if best_assignment is not None and time.monotonic() >= deadline:
+            break
+
+        assignment = _local_search(samples, start, num_folds, fold_ratio,
+                                   deadline)
+        cost = _assignment_cost(samples, assignment, num_folds, fold_ratio)
+        if best_cost is None or cost < best_cost:
+            best_assignment, best_cost = assignment, cost
+
+    return best_assignment
+
+
+def _mip_assignment(samples: np.ndarray, num_folds: int, verbose=False,
+                    max_seconds=None) -> np.ndarray:
+    """Assign samples to balanced folds through an integer program.
+
+    The program is solved by HiGHS (via :func:`scipy.optimize.milp`),
+    for at most ``max_seconds`` if given.
+
+    Return an array containing the fold index of each sample.
+    """
+    num_samples = len(samples)
+    fold_ratio = samples.sum() / (num_folds * 2)
+
+    # Variables: folds_x[fold_index * num_samples + sample_index],
+    # followed by max_, which is minimized
+    num_x = num_folds * num_samples
+    objective = np.zeros(num_x + 1)
+    objective[-1] = 1
+
+    # Each sample is exclusive to one fold
+    exclusivity = sparse.hstack((
+        sparse.kron(np.ones((1, num_folds)), sparse.identity(num_samples)),
+        sparse.csr_matrix((num_samples, 1))))
+
+    # Compute counts for negative and positive labels (one row per
+    # fold and label), minimize their distance from the target amounts
+    counts = sparse.kron(sparse.identity(num_folds), samples.T)
+    max_column = np.ones((counts.shape[0], 1))
+    over_ratio = sparse.hstack((counts, -max_column))
+    under_ratio = sparse.hstack((counts, max_column))
+
+    # A greedy solution bounds the optimum from above, letting the
+    # solver prune more branches from the beginning
+    greedy_assignment = _greedy_assignment(samples, num_folds)
+    fold_counts = np.zeros((num_folds, 2))
+    np.add.at(fold_counts, greedy_assignment, samples)
+    max_bound = math.ceil(np.abs(fold_counts - fold_ratio).max())
+
+    # Folds are interchangeable, any permutation of a solution is
+    # equivalent. Label folds by the first sample they contain, so that
+    # sample k can only be in folds 0..k: symmetric subtrees are not
+    # explored. This only affects the internal labeling of the folds
+    x_upper = np.arange(num_folds)[:, None] <= np.arange(num_samples)
+
+    constraints = (
+        LinearConstraint(exclusivity, 1, 1),
+        LinearConstraint(over_ratio, -np.inf, fold_ratio),
+        LinearConstraint(under_ratio, fold_ratio, np.inf))
+    bounds = Bounds(np.zeros(num_x + 1),
+                    np.append(x_upper.ravel(), max_bound))
+
+    options = {'disp': verbose}
+    if max_seconds is not None:
+        options['time_limit'] = max_seconds
+    result = milp(objective, integrality=np.ones(num_x + 1),
+                  bounds=bounds, constraints=constraints, options=options)
+
+    if verbose:
+        print('status', result.status, result.message)
+
+    # No solution found in time
+    if result.x is None:
+        return greedy_assignment
+
+    return result.x[:num_x].reshape(num_folds, num_samples).argmax(axis=0)
 
 
 def compute_folds(samples, num_folds=5, verbose=False,
-                  max_seconds=10, seed=None) -> Tuple[List[bool], ...]:
+                  max_seconds=10, seed=None,
+                  use_mip=False) -> Tuple[List[bool], ...]:
     """Retrieve balanced kfolds at document level.
 
     Expects as input a ``(N, 2)`` matrix where each sample represents a
     document: ``N`` is the number of documents. The two columns
     represent the number of positive and negative labels per each
-    document. The function employs an integer programming model to
-    provide ``num_folds`` partitions over the samples, as balanced as
-    possible in terms of total number of positives and negatives.
+    document. The function provides ``num_folds`` partitions over the
+    samples, as balanced as possible in terms of total number of
+    positives and negatives.
+
+    By default, a multi-start greedy and local search heuristic is
+    employed, running for at most ``max_seconds`` (at least one start
+    is always completed). ``seed`` controls its random restarts.
+    If ``use_mip`` is set, an integer programming model is solved
+    instead (via HiGHS) within ``max_seconds``, ``seed`` is then
+    ignored.
 
     Output is a tuple in the form: ``(boolean_fold_0, ...)``.
     Each element of the tuple is a boolean list that can be used to
@@ -27,99 +241,65 @@ def compute_folds(samples, num_folds=5, verbose=False,
 
     Length of the tuple is always ``num_folds``.
     """
+    samples = np.asarray(samples)
     folds_range = range(num_folds)
-    samples_range = range(len(samples))
-    total_instances = sum(map(sum, samples))
-    fold_ratio = total_instances / (num_folds * 2)
 
-    model = LpProblem(name='balanced_kfolds', sense=const.LpMinimize)
+    if use_mip:
+        assignment = _mip_assignment(samples, num_folds, verbose=verbose,
+                                     max_seconds=max_seconds)
+    else:
+        assignment = _heuristic_assignment(samples, num_folds,
+                                           max_seconds=max_seconds,
+                                           seed=seed)
 
-    # folds_x[fold_index][sample_index]
-    folds_x = [[LpVariable(name=f"folds_x[{i}][{j}]", cat=const.LpBinary)
-                for i in samples_range]
-               for j in folds_range]
-    max_ = LpVariable(name="max_", cat=const.LpInteger)
+    if verbose:
+        fold_counts = np.zeros((num_folds, 2), dtype=samples.dtype)
+        np.add.at(fold_counts, assignment, samples)
 
-    model += max_
+        print('folds:', [np.flatnonzero(assignment == fold_index).tolist()
+                         for fold_index in folds_range])
+        print('folds positive counts:', fold_counts[:, 1].tolist())
+        print('folds negative counts:', fold_counts[:, 0].tolist())
 
-    # Each sample is exclusive to one fold
-    for sample_index in samples_range:
-        model += lpSum(folds_x[fold_index][sample_index]
-                       for fold_index in folds_range) == 1
-
-    # Compute counts for positive and negative labels,
-    # minimize their distance from the target amounts
-    positives = [lpSum(folds_x[fold_index][sample_index]
-                       * samples[sample_index][1]
-                       for sample_index in samples_range)
-                 for fold_index in folds_range]
-    negatives = [lpSum(folds_x[fold_index][sample_index]
-                       * samples[sample_index][0]
-                       for sample_index in samples_range)
-                 for fold_index in folds_range]
-
-    for value in chain(positives, negatives):
-        model += value - fold_ratio <= max_
-        model += - (value - fold_ratio) <= max_
-
-    options = []
-    if seed is not None:
-        options.append(f'RandomS {seed}')
-    status = model.solve(COIN(msg=verbose, options=options))
-
-    if verbose:
-        output_folds = [[] for _ in folds_range]
-        folds_values_positives = [0] * num_folds
-        folds_values_negatives = [0] * num_folds
-        for fold_index in folds_range:
-            for sample_index in samples_range:
-                print(folds_x[fold_index][sample_index].varValue)
-                if folds_x[fold_index][sample_index].varValue:
-                    output_folds[fold_index].append(sample_index)
-                    folds_values_positives[fold_index] += samples[
-                        sample_index][1]
-                    folds_values_negatives[fold_index] += samples[
-                        sample_index][0]
-
-        print('folds:', output_folds)
-        print('folds positive counts:', folds_values_positives)
-        print('folds negative counts:', folds_values_negatives)
-
-        print('status', status)
-
-    return tuple(
-        list(map(lambda x: bool(round(x.varValue)), fold_vars))
-        for fold_vars in folds_x
-    )
+    return tuple((assignment == fold_index).tolist()
+                 for fold_index in folds_range)
 
 
 def compute_decision_folds(dataframe: pd.DataFrame, num_folds=5, verbose=False,
-                           max_seconds=10,
-                           seed=None) -> Tuple[List[bool], ...]:
+                           max_seconds=10, seed=None,
+                           use_mip=False) -> Tuple[np.ndarray, ...]:
     """Use :func:`compute_folds` to compute a split at decision level.
 
     Meaning of optional arguments and output format are relatable to
     the ones of :func:`compute_folds`, but at decision level instead of
     document level. Note that the split still happens at document level,
     this function simply expands it at a finer granularity for practical
-    reasons.
+    reasons. Folds are given as boolean arrays, one value per row of
+    the dataframe.
     """
-    document_labels_df = (
-        pd.get_dummies(dataframe[['document_index', 'label']],
-                       columns=['label']).groupby('document_index').sum())
-    document_folds = compute_folds(document_labels_df.values,
+    # Count labels per document: (N_documents, N_labels)
+    document_ids, document_inverse = np.unique(
+        dataframe['document_index'].to_numpy(), return_inverse=True)
+    label_ids, label_inverse = np.unique(dataframe['label'].to_numpy(),
+                                         return_inverse=True)
+    document_labels = np.zeros((len(document_ids), len(label_ids)),
+                               dtype=np.int64)
+    np.add.at(document_labels, (document_inverse, label_inverse), 1)
+
+    document_folds = compute_folds(document_labels,
                                    num_folds=num_folds,
                                    verbose=verbose,
                                    max_seconds=max_seconds,
-                                   seed=seed)
+                                   seed=seed,
+                                   use_mip=use_mip)
 
-    return tuple(
-        dataframe.document_index.isin(document_labels_df[document_fold].index)
-        for document_fold in document_folds)
+    # Expand each document's fold to its decisions
+    return tuple(np.asarray(document_fold)[document_inverse]
+                 for document_fold in document_folds)
 
 
 def split(dataframe: pd.DataFrame, num_folds=5, max_seconds=10,
-          seed=None) -> Iterable[Tuple[List[int], List[int]]]:
+          seed=None, use_mip=False) -> Iterable[Tuple[List[int], List[int]]]:
     """Generator of train-test splits based on document level kfolds.
 
     Designed to be in a format similar to the one of ``scikit-learn``
@@ -129,9 +309,9 @@ def split(dataframe: pd.DataFrame, num_folds=5, max_seconds=10,
     Yields a pair of list of indeces: ``(train_indeces, test_indeces)``
     """
     folds = compute_decision_folds(dataframe, num_folds=num_folds,
-                                   max_seconds=max_seconds, seed=seed)
-    for i, test_split in enumerate(folds):
-        train_folds = folds[:i] + folds[i + 1:]
-        train_split = reduce(or_, train_folds,
-                             np.array(train_folds[0]))
-        yield np.where(train_split)[0], np.where(test_split)[0]
+                                   max_seconds=max_seconds, seed=seed,
+                                   use_mip=use_mip)
+    # Folds partition the decisions: the training split of a fold is
+    # simply the complement of its test split
+    for test_split in np.stack(folds):
+        yield np.where(~test_split)[0], np.where(test_split)[0]
@@ -1,5 +1,8 @@
 import os
-from typing import Dict
+import re
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Mapping
 
 import importlib_resources as resources
 
@@ -7,15 +10,34 @@ LEMMATIZATION_RESOURCES = 'vjp.lemmatization'
 LEMMATIZATION_IT_FILE = (resources.files(LEMMATIZATION_RESOURCES)
                          / 'lemmatization-it.txt')
 
+# Lines are in the form: lemma<TAB>word
+_LEMMA_LINE_RE = re.compile(r'([^\t\r\n]+)\t([^\t\r\n]+)')
 
-def load_lemmas(file: os.PathLike = LEMMATIZATION_IT_FILE
-                ) -> Dict[str, str]:
-    """Load dictionary of lemmas."""
-    with open(file) as file:
-        lines = file.read().splitlines()
 
-    lemmas_dict = dict(reversed(line.split('\t')) for line in lines)
-    keys_dict = dict(zip(lemmas_dict.values(), lemmas_dict.values()))
-    lemmas_dict.update(keys_dict)
+@lru_cache(maxsize=4)
+def _parse_lemmas(path: str, mtime: float) -> Dict[str, str]:
+    """Parse a file of lemmas, see :func:`load_lemmas`.
+
+    ``mtime`` is not used, it is part of the cache key so that modified
+    files are parsed again.
+    """
+    with open(path, 'rb') as file:
+        text = file.read().decode('utf-8')
+
+    lemmas_dict = {word: lemma
+                   for lemma, word in _LEMMA_LINE_RE.findall(text)}
+    # Lemmas are mapped to themselves
+    lemmas_dict.update({lemma: lemma for lemma in lemmas_dict.values()})
 
     return lemmas_dict
+
+
+def load_lemmas(file: os.PathLike = LEMMATIZATION_IT_FILE
+                ) -> Mapping[str, str]:
+    """Load dictionary of lemmas.
+
+    Files are parsed once and cached (until they are modified). The
+    returned mapping is shared, hence read-only.
+    """
+    path = os.fspath(file)
+    return MappingProxyType(_parse_lemmas(path, os.path.getmtime(path)))
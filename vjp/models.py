@@ -3,6 +3,7 @@ from typing import Sequence, Iterable, Tuple
 
 import pandas as pd
 import numpy as np
+from joblib import parallel_backend
 from sklearn.base import BaseEstimator
 from sklearn.model_selection import cross_val_score
 
@@ -21,6 +22,15 @@ def cross_validate(model: BaseEstimator, dataframe: pd.DataFrame,
 
     Return a numpy array containing the scores (one per validation
     split).
+
+    Splits are computed once, beforehand. Validation splits are scored
+    in parallel, while each worker is limited to one thread to avoid
+    oversubscription (e.g. of BLAS threads).
     """
     X, y = data.count_based_X_y(dataframe, tags)
-    return cross_val_score(model, X, y, scoring=scoring, cv=cv, n_jobs=n_jobs)
+    # Plain arrays are cheaper to send to workers
+    X, y = X.to_numpy(), y.to_numpy()
+
+    with parallel_backend('loky', inner_max_num_threads=1):
+        return cross_val_score(model, X, y, scoring=scoring, cv=list(cv),
+                               n_jobs=n_jobs)
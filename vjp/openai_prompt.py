@@ -1,8 +1,84 @@
-from typing import Tuple
+import os
+import re
+import asyncio
+from functools import cached_property, lru_cache
+from typing import Hashable, List, MutableMapping, Optional, Tuple
 import openai
 import tiktoken
+import diskcache
+import xxhash
+from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
+                      wait_exponential_jitter, RetryCallState)
 
 MAX_TOKEN_FOR_PROMPT = 5
+CACHE_PATH_ENV = 'VJP_PROMPT_CACHE'
+FULL_CACHE_KEYS_ENV = 'VJP_PROMPT_CACHE_FULL_KEYS'
+
+# Transient errors, requests failing for other reasons are not retried
+RETRY_ERRORS = (openai.error.RateLimitError,
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.APIError)
+
+# Tokenizers are shared among prompts
+_encoding_for_model = lru_cache(maxsize=8)(tiktoken.encoding_for_model)
+
+
+def _print_retry(retry_state: RetryCallState):
+    print(str(retry_state.outcome.exception()))
+
+
+_retry_request = retry(
+    stop=stop_after_attempt(6),
+    wait=wait_exponential_jitter(initial=1, max=60, jitter=1),
+    retry=retry_if_exception_type(RETRY_ERRORS),
+    before_sleep=_print_retry,
+    reraise=True)
+
+
+def _cache_keys(prompt: list[dict], *model_names: str) -> List[Hashable]:
+    """Keys of a prompt in the cache, one per given model.
+
+    Keys are 64 bit xxh3 digests of the prompt turns and model name.
+    If the ``VJP_PROMPT_CACHE_FULL_KEYS`` environment variable is set,
+    ``(model_name, turns)`` tuples are used instead (e.g. to rule out
+    collisions while debugging).
+
+    Responses cached under a different key format (e.g. the tuples
+    used before digests were introduced) are not found, and are
+    requested again.
+    """
+    if os.environ.get(FULL_CACHE_KEYS_ENV):
+        turns = tuple((turn['role'], turn['content']) for turn in prompt)
+        return [(model_name, turns) for model_name in model_names]
+
+    turns_hash = xxhash.xxh3_64()
+    for turn in prompt:
+        turns_hash.update(b'\x00')
+        turns_hash.update(turn['role'].encode())
+        turns_hash.update(b'\x01')
+        turns_hash.update(turn['content'].encode())
+
+    keys = []
+    for model_name in model_names:
+        key_hash = turns_hash.copy()
+        key_hash.update(b'\x02')
+        key_hash.update(model_name.encode())
+        keys.append(key_hash.intdigest())
+    return keys
+
+
+@_retry_request
+def _create_chat_completion(**kwargs) -> str:
+    res = openai.ChatCompletion.create(**kwargs)
+    return res['choices'][0]['message']['content']
+
+
+@_retry_request
+async def _acreate_chat_completion(**kwargs) -> str:
+    res = await openai.ChatCompletion.acreate(**kwargs)
+    return res['choices'][0]['message']['content']
 
 
 class Prompt:
@@ -12,18 +88,48 @@ class Prompt:
                  verbalizer: Tuple[str, str],
                  model_short_name: str = "gpt-3.5-turbo",
                  model_long_name: str = "gpt-3.5-turbo-16k",
-                 few_shot_data: list = None) -> None:
+                 few_shot_data: list = None,
+                 cache_path: Optional[str] = None) -> None:
         self.template = template
         self.verbalizer = verbalizer
+        # Verbalizers as whole words, positive first then negative
+        self._verbalizer_res = tuple(
+            re.compile(rf'(?<!\w){re.escape(word)}(?!\w)', re.IGNORECASE)
+            for word in verbalizer)
 
         self.model_short_name = model_short_name
         self.model_long_name = model_long_name
 
-        self.short_tokenizer = tiktoken.encoding_for_model(model_short_name)
-        self.long_tokenizer = tiktoken.encoding_for_model(model_long_name)
+        self.short_tokenizer = _encoding_for_model(model_short_name)
+        self.long_tokenizer = _encoding_for_model(model_long_name)
 
         self.few_shot_data = few_shot_data
-        self.cache = {}
+        # Few shot messages (by with_mot) and token counts of messages
+        # shared among prompts, computed once
+        self._few_shots = {}
+        self._message_tokens = {}
+
+        self.cache_path = (cache_path if cache_path is not None
+                           else os.environ.get(CACHE_PATH_ENV))
+
+    @cached_property
+    def cache(self) -> MutableMapping[Hashable, str]:
+        """Responses, keyed on model name and prompt turns.
+
+        See :func:`_cache_keys` for the format of the keys.
+
+        If a ``cache_path`` is given (or the ``VJP_PROMPT_CACHE``
+        environment variable is set), responses are persisted on disk
+        through :mod:`diskcache` and survive across runs. Otherwise,
+        they are kept in memory.
+        """
+        if self.cache_path is None:
+            return {}
+        return diskcache.Cache(self.cache_path)
+
+    def clear_cache(self):
+        """Remove all cached responses."""
+        self.cache.clear()
 
     def create_prompt(self, process: dict,
                       with_mot: bool = False) -> list[dict]:
@@ -32,7 +138,10 @@ class Prompt:
              "content": self.template.format(*self.verbalizer)},
         ]
         if self.few_shot_data is not None:
-            messages.extend(self._get_few_shots(with_mot))
+            if with_mot not in self._few_shots:
+                self._few_shots[with_mot] = self._get_few_shots(with_mot)
+            # Copied, as prompts may be modified when truncated
+            messages.extend(map(dict, self._few_shots[with_mot]))
 
         text = self._process_message(process, with_mot)
         messages.append({"role": "user",
@@ -41,13 +150,55 @@ class Prompt:
         return messages
     
     def truncate_content_to_size(self, content, size=16370):
-        if len(self.long_tokenizer.encode(content)) > size:
-            return self.truncate_content_to_size(content[:-1], size)
+        tokens = self.long_tokenizer.encode(content)
+        if len(tokens) > size:
+            # The cut may split a multi-byte character, drop its bytes
+            return self.long_tokenizer.decode(tokens[:size],
+                                              errors='ignore')
         return content
 
-    def send_prompt(self, prompt: list[dict], mockup: bool = False) -> str:
+    def _cached_response(self, prompt: list[dict]) -> Optional[str]:
+        """Look up the response to a prompt, without tokenizing it.
+
+        The prompt may have been sent to either model. Return ``None``
+        if it is not cached.
+        """
+        for cache_key in _cache_keys(prompt, self.model_short_name,
+                                     self.model_long_name):
+            res = self.cache.get(cache_key)
+            if res is not None:
+                return res
+        return None
+
+    def _count_tokens(self, prompt: list[dict]) -> int:
+        """Count the tokens of a prompt, formatted by get_nice_prompt.
+
+        Messages are tokenized separately, as no token spans across
+        them (each message starts with ``###``, after a newline). All
+        messages but the last are usually shared among prompts (system
+        message, few shots), their counts are computed once.
+        """
+        *shared_messages, last_message = prompt
         num_token = len(self.short_tokenizer.encode(
-            self.get_nice_prompt(prompt)))
+            self.get_nice_prompt([last_message])))
+
+        for message in shared_messages:
+            key = message['role'], message['content']
+            message_tokens = self._message_tokens.get(key)
+            if message_tokens is None:
+                message_tokens = len(self.short_tokenizer.encode(
+                    self.get_nice_prompt([message])))
+                self._message_tokens[key] = message_tokens
+            num_token += message_tokens
+
+        return num_token
+
+    def _prepare_prompt(self, prompt: list[dict]) -> Tuple[str, Hashable]:
+        """Truncate a prompt if needed, select the model to send it to.
+
+        Return the model name and the key of the prompt in the cache.
+        """
+        num_token = self._count_tokens(prompt)
 
         if num_token > 16370:
             if len(prompt) > 2:
@@ -61,51 +212,113 @@ class Prompt:
         else:
             model_name = self.model_short_name
 
-        hashable_prompt = tuple(tuple(sorted(turn.items())) for turn in prompt)
-        if (model_name in self.cache
-                and hashable_prompt in self.cache[model_name]):
-            return self.cache[model_name][hashable_prompt]
+        cache_key, = _cache_keys(prompt, model_name)
+        return model_name, cache_key
+
+    def send_prompt(self, prompt: list[dict], mockup: bool = False) -> str:
+        res = self._cached_response(prompt)
+        if res is not None:
+            return res
+
+        # Truncated prompts are only found once truncated
+        model_name, cache_key = self._prepare_prompt(prompt)
+        if cache_key in self.cache:
+            return self.cache[cache_key]
 
         def _actually_send(prompt):
             if mockup:
                 return self.verbalizer[1]
-            import time
-            while True:
-                try:
-                    res = openai.ChatCompletion.create(
-                        model=model_name,
-                        messages=prompt,
-                        max_tokens=MAX_TOKEN_FOR_PROMPT,
-                        temperature=0
-                        )
-                    return res['choices'][0]['message']['content']
-                except Exception as e:
-                    print(str(e))
-                    time.sleep(0.5)
+            return _create_chat_completion(
+                model=model_name,
+                messages=prompt,
+                max_tokens=MAX_TOKEN_FOR_PROMPT,
+                temperature=0
+                )
         res = _actually_send(prompt)
 
-        if model_name not in self.cache:
-            self.cache[model_name] = {}
+        # Mockup responses would shadow real ones in persistent caches
+        if not mockup:
+            self.cache[cache_key] = res
+        return res
+
+    async def _send_prompt_async(self, prompt: list[dict],
+                                 semaphore: asyncio.Semaphore,
+                                 mockup: bool = False) -> str:
+        res = self._cached_response(prompt)
+        if res is not None:
+            return res
 
-        self.cache[model_name][hashable_prompt] = res
+        # Truncated prompts are only found once truncated
+        model_name, cache_key = self._prepare_prompt(prompt)
+        if cache_key in self.cache:
+            return self.cache[cache_key]
+
+        async def _actually_send(prompt):
+            if mockup:
+                return self.verbalizer[1]
+            async with semaphore:
+                return await _acreate_chat_completion(
+                    model=model_name,
+                    messages=prompt,
+                    max_tokens=MAX_TOKEN_FOR_PROMPT,
+                    temperature=0
+                    )
+        res = await _actually_send(prompt)
+
+        # Mockup responses would shadow real ones in persistent caches
+        if not mockup:
+            self.cache[cache_key] = res
         return res
 
+    async def send_prompts_async(self, prompts: list[list[dict]],
+                                 mockup: bool = False,
+                                 concurrency: int = 8) -> list[str]:
+        """Send many prompts concurrently.
+
+        At most ``concurrency`` requests are pending at the same time.
+        Identical prompts are sent only once. Responses are cached as in
+        :meth:`send_prompt` and returned in the same order as
+        ``prompts``.
+        """
+        # Before being cached, identical prompts would all be sent
+        unique_prompts = {}
+        prompt_keys = []
+        for prompt in prompts:
+            prompt_key, = _cache_keys(prompt, self.model_short_name)
+            unique_prompts.setdefault(prompt_key, prompt)
+            prompt_keys.append(prompt_key)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        responses = await asyncio.gather(
+            *(self._send_prompt_async(prompt, semaphore, mockup)
+              for prompt in unique_prompts.values()))
+
+        key_responses = dict(zip(unique_prompts, responses))
+        return [key_responses[prompt_key] for prompt_key in prompt_keys]
+
+    def send_prompts(self, prompts: list[list[dict]], mockup: bool = False,
+                     concurrency: int = 8) -> list[str]:
+        """Synchronous version of :meth:`send_prompts_async`.
+
+        Cannot be called from a running event loop (e.g. in a notebook),
+        where ``await prompt.send_prompts_async(...)`` shall be used
+        instead.
+        """
+        return asyncio.run(self.send_prompts_async(prompts, mockup,
+                                                   concurrency))
+
     def interpret_response(self, response: str):
-        response = response.lower()
-        if self.verbalizer[0] in response:
+        positive_re, negative_re = self._verbalizer_res
+        if positive_re.search(response):
             return 1
-        elif self.verbalizer[1] in response:
+        elif negative_re.search(response):
             return 0
         else:
             raise Exception("Result not in the correct format")
 
     def get_nice_prompt(self, prompt: list[dict]):
-        res = ""
-        for message in prompt:
-            role, content = message['role'], message['content']
-            res += f"###{role}\n"
-            res += f'{content}\n'
-        return res
+        return ''.join(f"###{message['role']}\n{message['content']}\n"
+                       for message in prompt)
 
     def _get_few_shots(self, with_mot: bool=False):
         messages = []
@@ -6,10 +6,10 @@ level of preprocessing to meet.
 import argparse
 import enum
 import pathlib
+from itertools import chain
 from typing import Sequence, Set
 
 import importlib_resources as resources
-import networkx as nx
 import pandas as pd
 
 import vjp.data as data
@@ -45,13 +45,17 @@ class Namespace:
 class NewAddAction(argparse.Action):
     """Custom argparse action: add value to a set.
 
-    Overrides defaults.
+    Overrides defaults, once per parsed namespace.
     """
-    new_set_created = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Namespace in which the default was last replaced
+        self.new_set_namespace = None
 
     def __call__(self, parser, namespace, values, option_string=None):
-        if not self.new_set_created:
-            self.new_set_created = True
+        if self.new_set_namespace is not namespace:
+            self.new_set_namespace = namespace
             setattr(namespace, self.dest, set())
 
         getattr(namespace, self.dest).update(values)
@@ -60,13 +64,17 @@ class NewAddAction(argparse.Action):
 class NewAppendAction(argparse.Action):
     """Custom argparse action: append value to list.
 
-    Overrides defaults.
+    Overrides defaults, once per parsed namespace.
     """
-    new_list_created = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Namespace in which the default was last replaced
+        self.new_list_namespace = None
 
     def __call__(self, parser, namespace, values, option_string=None):
-        if not self.new_list_created:
-            self.new_list_created = True
+        if self.new_list_namespace is not namespace:
+            self.new_list_namespace = namespace
             setattr(namespace, self.dest, [])
 
         getattr(namespace, self.dest).extend(values)
@@ -76,21 +84,21 @@ def preprocess(namespace: Namespace) -> pd.DataFrame:
     """Apply preprocessing based on the given parameters."""
     level = namespace.level.value
 
-    # Load data
+    # Load data, one folder at a time: documents are filtered as they
+    # are loaded
     if namespace.input_folders:
-        documents = sum((data.load_directory(directory)
-                        for directory in namespace.input_folders), start=[])
+        documents = chain.from_iterable(
+            data.load_directory(directory)
+            for directory in namespace.input_folders)
     else:           # Default to existing provided data
         documents = data.load_second_instance()
 
     # Apply preprocessing pipeline based on given level
     documents = data.filter_other_outcomes(documents)
     documents = data.sort_documents(documents)
-    triples_gen = (data.build_tag_triples(document, namespace.edge_relations)
-                   for document in documents)
-    graphs = [nx.from_pandas_edgelist(triples, edge_attr='edge',
-                                      create_using=nx.DiGraph())
-              for triples in triples_gen]
+    graphs = data.graphs_from_triples(
+        [data.build_tag_triples(document, namespace.edge_relations)
+         for document in documents])
     dataframe = data.dataframe_from_graphs(
         graphs, documents, tag_names=namespace.connected_component_tags,
         join_token=namespace.tag_join_token,
@@ -102,8 +110,13 @@ def preprocess(namespace: Namespace) -> pd.DataFrame:
 
 
 def dump_preprocess(namespace: Namespace):
-    """Apply preprocessing and dump to file."""
-    preprocess(namespace).to_parquet(namespace.output_file)
+    """Apply preprocessing and dump to file.
+
+    The preprocessed dataframe is fully built in memory, then written
+    as a single zstd compressed parquet file.
+    """
+    preprocess(namespace).to_parquet(namespace.output_file,
+                                     compression='zstd')
 
 
 if __name__ == '__main__':
@@ -122,7 +135,7 @@ if __name__ == '__main__':
                         dest='connected_component_tags', type=str,
                         action=NewAppendAction)
 
-    parser.add_argument('-c', '--use_child_text_tag_names', nargs='*',
+    parser.add_argument('-u', '--use_child_text_tag_names', nargs='*',
                         dest='use_child_text_tag_names', type=str,
                         action=NewAppendAction)
 
@@ -1,15 +1,17 @@
 """Text manipulation."""
 import re
-from typing import Callable, Dict
-from functools import partial
+from typing import Callable, FrozenSet, Mapping, Union
+from functools import partial, lru_cache
+from itertools import chain
 
+import pandas as pd
 import nltk
 from nltk.corpus import stopwords
 from gensim.parsing.preprocessing import remove_stopwords as rem_stopwords
 
 import vjp.lemmatization as lemmatization
 
-lemmatization_dict: Dict[str, str] = lemmatization.load_lemmas()
+lemmatization_dict: Mapping[str, str] = lemmatization.load_lemmas()
 
 # Can be used in pipelines to substitute whitespaces (and more)
 multiple_newlines_re = re.compile(r'\n+')
@@ -25,21 +27,78 @@ def load_stopwords():
 
 
 def text_pipeline(*callables: Callable[[str], str]) -> Callable[[str], str]:
-    """Build a text pipeline from a sequence of callables/pipelines."""
-    def pipeline(text: str) -> str:
-        for callable_ in callables:
-            text = callable_(text)
-        return text
+    """Build a text pipeline from a sequence of callables/pipelines.
 
+    Nested pipelines are flattened. The pipeline is compiled to a
+    function calling its steps one after the other, with no loop over
+    them. Steps are exposed as its ``steps`` attribute.
+    """
+    steps = tuple(chain.from_iterable(
+        getattr(callable_, 'steps', (callable_,)) for callable_ in callables))
+    step_names = [f'step_{index}' for index in range(len(steps))]
+    source = ''.join(chain(
+        ('def pipeline(text):\n',),
+        (f'    text = {name}(text)\n' for name in step_names),
+        ('    return text\n',)))
+
+    namespace = dict(zip(step_names, steps))
+    exec(source, namespace)
+    pipeline = namespace['pipeline']
+    pipeline.steps = steps
     return pipeline
 
 
+def apply_pipeline(data: Union[pd.Series, pd.DataFrame],
+                   pipeline: Callable[[str], str]
+                   ) -> Union[pd.Series, pd.DataFrame]:
+    """Apply a text pipeline to each text of a series or dataframe.
+
+    Same as ``data.applymap(pipeline)`` on dataframes, but each distinct
+    text of a column is processed once. Texts are often repeated among
+    rows (e.g. the facts of a document are shared by all its
+    decisions).
+    """
+    if isinstance(data, pd.DataFrame):
+        return data.apply(apply_pipeline, pipeline=pipeline)
+
+    unique_texts = data.unique()
+    return data.map(dict(zip(unique_texts, map(pipeline, unique_texts))))
+
+
+@lru_cache(maxsize=None)
+def _italian_stopwords() -> FrozenSet[str]:
+    return frozenset(stopwords.words('italian'))
+
+
 def remove_stopwords(text: str) -> str:
     """Remove stopwords from text.
 
     Stopwords must be first loaded via :func:`load_stopwords`.
     """
-    return rem_stopwords(text, stopwords=stopwords.words('italian'))
+    return rem_stopwords(text, stopwords=_italian_stopwords())
+
+
+class _NonAlnumTable(dict):
+    """Translation table replacing non alphanumerical characters.
+
+    Meant for :meth:`str.translate`. Code points are tested (via
+    :meth:`str.isalnum`) the first time they are looked up.
+    """
+
+    def __init__(self, replace_with: str):
+        super().__init__()
+        self.replace_with = replace_with
+
+    def __missing__(self, code_point: int):
+        value = (code_point if chr(code_point).isalnum()
+                 else self.replace_with)
+        self[code_point] = value
+        return value
+
+
+@lru_cache(maxsize=8)
+def _non_alnum_table(replace_with: str) -> _NonAlnumTable:
+    return _NonAlnumTable(replace_with)
 
 
 def remove_punctuation(text: str, replace_with=' ') -> str:
@@ -51,11 +110,27 @@ def remove_punctuation(text: str, replace_with=' ') -> str:
     This helps since no sofisticated lemmatization for such cases is
     employed.
     """
-    return ''.join(c if c.isalnum() else replace_with for c in text)
+    return text.translate(_non_alnum_table(replace_with))
+
+
+def _lemmatize_drop(text: str,
+                    lemmatization_dict: Mapping[str, str] = lemmatization_dict
+                    ) -> str:
+    """Lemmatize text, dropping missing words. See :func:`lemmatize`."""
+    return ' '.join([lemmatization_dict[word] for word in text.split()
+                     if word in lemmatization_dict])
+
+
+def _lemmatize_keep(text: str,
+                    lemmatization_dict: Mapping[str, str] = lemmatization_dict
+                    ) -> str:
+    """Lemmatize text, keeping missing words. See :func:`lemmatize`."""
+    return ' '.join([lemmatization_dict.get(word, word)
+                     for word in text.split()])
 
 
 def lemmatize(text: str,
-              lemmatization_dict: Dict[str, str] = lemmatization_dict,
+              lemmatization_dict: Mapping[str, str] = lemmatization_dict,
               drop_missing=True) -> str:
     """Lemmatize text using the given lemmatization dict.
 
@@ -67,14 +142,8 @@ def lemmatize(text: str,
     dictionary) are completely removed.
     """
     if drop_missing:
-        map_fun = lemmatization_dict.get                        # NOQA
-    else:
-        map_fun = lambda w: lemmatization_dict.get(w, w)        # NOQA
-
-    lemmas = map(map_fun, text.split())
-    lemmas = filter(bool, lemmas)
-
-    return ' '.join(lemmas)
+        return _lemmatize_drop(text, lemmatization_dict)
+    return _lemmatize_keep(text, lemmatization_dict)
 
 
 count_pipeline_head = text_pipeline(
@@ -90,7 +159,7 @@ Designed to be used as head in more complex pipelines.
 
 count_drop_pipeline = text_pipeline(
     count_pipeline_head,
-    lemmatize
+    _lemmatize_drop
 )
 """Text preprocessing pipeline for count based encodings.
 
@@ -104,7 +173,7 @@ Uses :attr:`count_pipeline_head` as head.
 
 count_keep_pipeline = text_pipeline(
     count_pipeline_head,
-    partial(lemmatize, drop_missing=False)
+    _lemmatize_keep
 )
 """Text preprocessing pipeline for count based encodings.
 